@@ -1,21 +1,133 @@
 # dataset.py
+import numpy as np
 import torch
+import torch.distributed as dist
 import lightning as L
-from torch.nn.utils.rnn import pad_sequence
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, DistributedSampler, RandomSampler, Sampler, Subset
 import os
+import tempfile
+from typing import NamedTuple
 from gcs_utils import download_blob
 
+class Batch(NamedTuple):
+    inputs: torch.Tensor
+    targets: torch.Tensor
+    masks: torch.Tensor
+
+    def pin_memory(self):
+        # Called by the DataLoader's pin-memory thread when pin_memory=True
+        return Batch(self.inputs.pin_memory(), self.targets.pin_memory(), self.masks.pin_memory())
+
+    def to(self, device, non_blocking=False):
+        return Batch(
+            self.inputs.to(device, non_blocking=non_blocking),
+            self.targets.to(device, non_blocking=non_blocking),
+            self.masks.to(device, non_blocking=non_blocking)
+        )
+
+
 # Collate function outside the dataset class
 def collate_fn(batch):
     inputs, targets, masks = zip(*batch)
-    inputs_padded = pad_sequence(inputs, batch_first=True, padding_value=0)
-    targets_padded = pad_sequence(targets, batch_first=True, padding_value=0)
+    max_len = max(len(sequence) for sequence in inputs)
+    if all(len(sequence) == max_len for sequence in inputs):
+        return Batch(torch.stack(inputs, 0), torch.stack(targets, 0), torch.stack(masks, 0))
+
+    # Pad only to the longest sample in the batch; padded positions are masked out
+    inputs_padded = inputs[0].new_zeros(len(batch), max_len)
+    targets_padded = targets[0].new_zeros(len(batch), max_len)
+    masks_padded = masks[0].new_zeros(len(batch), max_len)
+    for i, (input_sequence, target_sequence, attention_mask) in enumerate(batch):
+        length = len(input_sequence)
+        inputs_padded[i, :length] = input_sequence
+        targets_padded[i, :length] = target_sequence
+        masks_padded[i, :length] = attention_mask
+    return Batch(inputs_padded, targets_padded, masks_padded)
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Groups samples of similar length into batches so each batch is padded only to its own
+    longest sample. Indices drawn from `sampler` are split into pools of
+    batch_size * bucket_factor, each pool is sorted by length and cut into batches, and
+    the batches are shuffled so consecutive steps do not walk through lengths in order.
+    The batch order comes from a generator seeded once from `seed`, so it is reproducible
+    across runs and differs between epochs without relying on set_epoch().
+    """
+    def __init__(self, sampler, lengths, batch_size, bucket_factor=50, seed=0):
+        self.sampler = sampler
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.bucket_factor = bucket_factor
+        self.generator = torch.Generator()
+        self.generator.manual_seed(seed)
+
+    def set_epoch(self, epoch):
+        # Lightning versions that call set_epoch on the batch sampler rather than on
+        # batch_sampler.sampler still need it to reach a DistributedSampler
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+    def __len__(self):
+        return (len(self.sampler) + self.batch_size - 1) // self.batch_size
 
-    # Create attention masks (1 for actual tokens, 0 for padding)
-    attention_masks = (inputs_padded != 0).long()
+    def __iter__(self):
+        indices = np.fromiter(self.sampler, dtype=np.int64)
+        pool_size = self.batch_size * self.bucket_factor
 
-    return inputs_padded, targets_padded, attention_masks
+        batches = []
+        for start in range(0, len(indices), pool_size):
+            pool = indices[start:start + pool_size]
+            pool = pool[np.argsort(self.lengths[pool], kind='stable')]
+            batches.extend(pool[i:i + self.batch_size].tolist() for i in range(0, len(pool), self.batch_size))
+
+        for i in torch.randperm(len(batches), generator=self.generator).tolist():
+            yield batches[i]
+
+
+class PrefetchLoader:
+    """
+    Wraps a DataLoader and copies the next batch to the GPU on a side stream while the
+    current batch is being used, so the host-to-device transfer overlaps with compute.
+    """
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    # Exposed so Lightning's per-epoch set_epoch() reaches the Random/DistributedSampler
+    # behind BucketBatchSampler
+    @property
+    def batch_sampler(self):
+        return self.loader.batch_sampler
+
+    def __iter__(self):
+        if self.device.type != 'cuda':
+            yield from self.loader
+            return
+
+        memcpy_stream = torch.cuda.Stream(self.device)
+        batches = iter(self.loader)
+        next_batch = self._get_next_batch(batches, memcpy_stream)
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(memcpy_stream)
+            batch = next_batch
+            # Keep the caching allocator from reusing these buffers while the main stream reads them
+            for tensor in batch:
+                tensor.record_stream(current_stream)
+            next_batch = self._get_next_batch(batches, memcpy_stream)
+            yield batch
+
+    def _get_next_batch(self, batches, memcpy_stream):
+        try:
+            batch = next(batches)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(memcpy_stream):
+            return batch.to(self.device, non_blocking=True)
 
 
 class TokenizedTextDataset(Dataset):
@@ -25,55 +137,126 @@ class TokenizedTextDataset(Dataset):
         self.padding_token = padding_token
         self.in_memory = in_memory
         self.data = []
-        self.line_offsets = []
+        self.mask = None
+        self.offsets = None
+        self.lengths = None
+        self._tokens = None
 
         if self.in_memory:
             self._load_dataset_into_memory()
         else:
-            self._index_file_positions()
+            self._load_binary_index()
 
     def _load_dataset_into_memory(self):
+        # Tokenize the whole file once into a (num_lines, sequence_length) tensor
         with open(self.file_path, 'r') as file:
-            for line in file:
-                self.data.append(line.strip())
+            num_lines = sum(1 for _ in file)
 
-    def _index_file_positions(self):
+        data = np.full((num_lines, self.sequence_length), self.padding_token, dtype=np.int64)
+        self.lengths = np.empty(num_lines, dtype=np.int64)
         with open(self.file_path, 'r') as file:
-            offset = 0
-            for line in file:
-                self.line_offsets.append(offset)
-                offset += len(line)
+            for i, line in enumerate(file):
+                self.lengths[i] = self._parse_line(line, data[i])
+
+        # Shared memory lets forked DataLoader workers read the same pages
+        self.data = torch.from_numpy(data).share_memory_()
+        self.mask = torch.from_numpy(data != self.padding_token).share_memory_()
+
+    def _parse_line(self, line, sequence):
+        """
+        Parses a line of token ids into a buffer pre-filled with padding, truncating if needed.
+        Returns the number of tokens written.
+        """
+        # Strip first: np.fromstring parses a whitespace-only string as a single 0
+        tokens = np.fromstring(line.strip(), dtype=np.int64, sep=' ')
+        length = min(tokens.size, self.sequence_length)
+        sequence[:length] = tokens[:length]
+        return length
+
+    @staticmethod
+    def _binary_paths(file_path):
+        return file_path + '.tokens.i32', file_path + '.offsets.npy'
+
+    @staticmethod
+    def preprocess_to_binary(file_path):
+        """
+        Converts a text file of token ids into a flat int32 token file plus an int64 array of
+        line start offsets (with a final end offset), so samples can be sliced without parsing.
+        """
+        tokens_path, offsets_path = TokenizedTextDataset._binary_paths(file_path)
+        # Write to unique temp files and rename into place, so processes building the same
+        # cache at once (e.g. every DDP rank in setup()) never read a half-written file
+        directory = os.path.dirname(os.path.abspath(file_path))
+        tokens_tmp = tempfile.NamedTemporaryFile(dir=directory, suffix='.tmp', delete=False)
+        offsets_tmp = tempfile.NamedTemporaryFile(dir=directory, suffix='.tmp', delete=False)
+        try:
+            lengths = []
+            with open(file_path, 'r', encoding='utf-8') as infile, tokens_tmp:
+                for line in infile:
+                    tokens = np.fromstring(line.strip(), dtype=np.int32, sep=' ')
+                    tokens.tofile(tokens_tmp)
+                    lengths.append(tokens.size)
+
+            offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            with offsets_tmp:
+                np.save(offsets_tmp, offsets)
+
+            os.replace(tokens_tmp.name, tokens_path)
+            os.replace(offsets_tmp.name, offsets_path)
+        finally:
+            for tmp in (tokens_tmp, offsets_tmp):
+                if os.path.exists(tmp.name):
+                    os.remove(tmp.name)
+        return tokens_path, offsets_path
+
+    def _load_binary_index(self):
+        tokens_path, offsets_path = self._binary_paths(self.file_path)
+        # Rebuild the binary files if they are missing or older than the text file
+        source_mtime = os.path.getmtime(self.file_path)
+        if not all(os.path.exists(path) and os.path.getmtime(path) >= source_mtime for path in (tokens_path, offsets_path)):
+            self.preprocess_to_binary(self.file_path)
+
+        self.offsets = np.load(offsets_path)
+        self.lengths = np.minimum(np.diff(self.offsets), self.sequence_length)
+
+    def _get_tokens(self):
+        """
+        Memory-maps the token file on first use, so the page cache serves hot samples and a
+        dataset pickled into a worker process does not carry the array with it.
+        """
+        if self._tokens is None:
+            tokens_path, _ = self._binary_paths(self.file_path)
+            if self.offsets[-1] == 0:
+                self._tokens = np.empty(0, dtype=np.int32)  # np.memmap cannot map an empty file
+            else:
+                self._tokens = np.memmap(tokens_path, dtype=np.int32, mode='r')
+        return self._tokens
 
     def __len__(self):
-        return len(self.data) if self.in_memory else len(self.line_offsets)
+        return len(self.data) if self.in_memory else len(self.offsets) - 1
 
     def __getitem__(self, idx):
-        if self.in_memory:
-            line = self.data[idx]
-        else:
-            with open(self.file_path, 'r') as file:
-                file.seek(self.line_offsets[idx])
-                line = file.readline().strip()
+        # Real tokens plus the padding target after the last one; collate_fn pads each
+        # batch back out to its longest sample
+        length = min(max(int(self.lengths[idx]), 1) + 1, self.sequence_length)
 
-        sequence = list(map(int, line.split()))
-
-        # Padding or truncating the sequence
-        if len(sequence) < self.sequence_length:
-            sequence += [self.padding_token] * (self.sequence_length - len(sequence))
+        if self.in_memory:
+            sequence, attention_mask = self.data[idx, :length], self.mask[idx, :length]
         else:
-            sequence = sequence[:self.sequence_length]
-
-        # Generate an attention mask for the sequence
-        attention_mask = [1 if token != self.padding_token else 0 for token in sequence]
+            start = self.offsets[idx]
+            count = min(int(self.lengths[idx]), length)
+            sequence = np.full(length, self.padding_token, dtype=np.int64)
+            sequence[:count] = self._get_tokens()[start:start + count]
+            sequence = torch.from_numpy(sequence)
 
-        input_sequence = torch.tensor(sequence[:-1], dtype=torch.long)
-        target_sequence = torch.tensor(sequence[1:], dtype=torch.long)
-        attention_mask = torch.tensor(attention_mask[:-1], dtype=torch.float)
+            # Generate an attention mask for the sequence
+            attention_mask = sequence != self.padding_token
 
-        return input_sequence, target_sequence, attention_mask
+        return sequence[:-1], sequence[1:], attention_mask[:-1]
 
 class GPTDataModule(L.LightningDataModule):
-    def __init__(self, train_blob_name, val_blob_name, bucket_name, batch_size=32, sequence_length=1024, local_data_dir='temp_data'):
+    def __init__(self, train_blob_name, val_blob_name, bucket_name, batch_size=32, sequence_length=1024, local_data_dir='temp_data', seed=0):
         super().__init__()
         self.train_blob_name = train_blob_name
         self.val_blob_name = val_blob_name
@@ -81,6 +264,7 @@ class GPTDataModule(L.LightningDataModule):
         self.batch_size = batch_size
         self.sequence_length = sequence_length
         self.local_data_dir = local_data_dir
+        self.seed = seed
 
     def setup(self, stage=None):
         """
@@ -101,11 +285,31 @@ class GPTDataModule(L.LightningDataModule):
         self.train_dataset = TokenizedTextDataset(self.train_file, self.sequence_length)
         self.val_dataset = TokenizedTextDataset(self.val_file, self.sequence_length)
 
+    def _loader_kwargs(self, dataset):
+        num_workers = min(os.cpu_count() or 1, 8)
+        # Forking workers costs more than it saves when an in-memory dataset is only a few batches
+        if dataset.in_memory and len(dataset) < self.batch_size * num_workers:
+            num_workers = 0
+        if num_workers == 0:
+            return {'num_workers': 0}
+        return {'num_workers': num_workers, 'persistent_workers': True, 'prefetch_factor': 2}
+
     def train_dataloader(self):
-        return DataLoader(self.train_dataset, batch_size=self.batch_size, shuffle=True, collate_fn=collate_fn, pin_memory=True, num_workers=4)
+        # Leave zero-length (blank) lines out: length sorting would group them into all-masked batches with a NaN loss
+        nonempty = np.flatnonzero(self.train_dataset.lengths > 0)
+        train_subset = Subset(self.train_dataset, nonempty)
+        # Shard across ranks under DDP; otherwise shuffle with a seeded generator for reproducibility
+        if dist.is_available() and dist.is_initialized():
+            sampler = DistributedSampler(train_subset, shuffle=True, seed=self.seed)
+        else:
+            sampler = RandomSampler(train_subset, generator=torch.Generator().manual_seed(self.seed))
+        batch_sampler = BucketBatchSampler(sampler, self.train_dataset.lengths[nonempty], self.batch_size, seed=self.seed)
+        loader = DataLoader(train_subset, batch_sampler=batch_sampler, collate_fn=collate_fn, pin_memory=True, **self._loader_kwargs(self.train_dataset))
+        device = self.trainer.strategy.root_device if self.trainer is not None else 'cpu'
+        return PrefetchLoader(loader, device)
 
     def val_dataloader(self):
-        return DataLoader(self.val_dataset, batch_size=self.batch_size, shuffle=False, collate_fn=collate_fn, pin_memory=True, num_workers=4)
+        return DataLoader(self.val_dataset, batch_size=self.batch_size, shuffle=False, collate_fn=collate_fn, pin_memory=True, **self._loader_kwargs(self.val_dataset))
 
     def teardown(self, stage=None):
         """
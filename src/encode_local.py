@@ -1,24 +1,55 @@
 # encode.py
 import os
 import json
+import numpy as np
 import tiktoken
 
-def restructure_data(input_file, output_file, context_window):
-    with open(input_file, 'r', encoding='utf-8') as file:
-        lines = file.readlines()
-
-    all_text = "".join(lines)
-    chunks = [all_text[i:i+context_window] for i in range(0, len(all_text), context_window)]
+def _iter_chunks(file, context_window, block_chunks=1024):
+    """
+    Yields consecutive context_window-sized pieces of a text file without loading it whole.
+    """
+    remainder = ''
+    while block := file.read(context_window * block_chunks):
+        text = remainder + block
+        end = len(text) - len(text) % context_window
+        for i in range(0, end, context_window):
+            yield text[i:i+context_window]
+        remainder = text[end:]
+    if remainder:
+        yield remainder
 
-    with open(output_file, 'w', encoding='utf-8') as file:
-        for idx, chunk in enumerate(chunks, start=1):  # Start the indexing from 1
+def restructure_data(input_file, output_file, context_window):
+    """
+    Restructure data into chunks of a specified context window.
+    """
+    with open(input_file, 'r', encoding='utf-8') as infile, \
+         open(output_file, 'w', encoding='utf-8') as outfile:
+        chunks = _iter_chunks(infile, context_window)
+        chunk = next(chunks, None)
+        idx = 1  # Start the indexing from 1
+        while chunk is not None:
+            # Look one chunk ahead so the last one can be flagged as ended
+            next_chunk = next(chunks, None)
             json_obj = {
                 "id": idx,
                 "text": chunk.strip(),
                 "length": len(chunk.split()),  # Number of words in the chunk
-                "ended": idx == len(chunks)  # True if it's the last chunk
+                "ended": next_chunk is None  # True if it's the last chunk
             }
-            file.write(json.dumps(json_obj) + '\n')
+            outfile.write(json.dumps(json_obj) + '\n')
+            chunk = next_chunk
+            idx += 1
+
+def _encode_jsonl_lines(encoder, infile, outfile):
+    """
+    Encodes the 'text' field of each JSON line and writes space-separated token ids, one
+    line per record. Lines are read in ~16MB batches so tiktoken can encode each batch
+    across its Rust thread pool instead of one call per line.
+    """
+    while lines := infile.readlines(1 << 24):
+        texts = [json.loads(line)['text'] for line in lines]
+        all_tokens = encoder.encode_ordinary_batch(texts, num_threads=os.cpu_count() or 1)
+        outfile.write(''.join(' '.join(map(str, tokens)) + '\n' for tokens in all_tokens))
 
 def encode_jsonl_file(input_file):
     # Initialize the tokenizer for GPT-2
@@ -30,15 +61,7 @@ def encode_jsonl_file(input_file):
 
     with open(input_file, 'r', encoding='utf-8') as infile, \
          open(output_file, 'w', encoding='utf-8') as outfile:
-        for line in infile:
-            # Parse the JSON line
-            data = json.loads(line)
-
-            # Encode the text
-            encoded_text = encoder.encode(data['text'])
-
-            # Convert encoded tokens to a string and write to the output file
-            outfile.write(' '.join(map(str, encoded_text)) + '\n')
+        _encode_jsonl_lines(encoder, infile, outfile)
 
     print(f"Encoded file saved as: {output_file}")
 
@@ -55,11 +78,13 @@ def encode_text_file(file_path, val_ratio=0.1, context_window=1024):
     with open(structured_file, 'r', encoding='utf-8') as file:
         sentences = file.readlines()
 
+    # Batch encoding lets tiktoken spread the work over its Rust thread pool
+    all_tokens = encoder.encode_ordinary_batch([sentence.strip() for sentence in sentences], num_threads=os.cpu_count() or 1)
+
+    # Build the whole output in one join and write it with a single call
+    encoded_text = ''.join(' '.join(map(str, tokens)) + '\n' for tokens in all_tokens)
     with open(encoded_file, 'w', encoding='utf-8') as file:
-        for sentence in sentences:
-            tokens = encoder.encode(sentence.strip())
-            token_str = ' '.join(map(str, tokens))
-            file.write(token_str + '\n')
+        file.write(encoded_text)
 
     format_and_split_data(encoded_file, train_file, val_file, val_ratio)
 
@@ -79,9 +104,11 @@ def format_and_split_data(file_path, train_file, val_file, val_ratio=0.1):
 def find_vocab_size(file_path):
     max_token = 0
     with open(file_path, 'r', encoding='utf-8') as file:
-        for line in file:
-            tokens = [int(token) for token in line.strip().split()]
-            max_token = max(max_token, max(tokens))
+        # Parse ~64MB of lines at a time in C rather than token by token in Python
+        while lines := file.readlines(1 << 26):
+            tokens = np.fromstring(''.join(lines), dtype=np.int64, sep=' ')
+            if tokens.size:
+                max_token = max(max_token, int(tokens.max()))
     return max_token + 1
 
 # Example usage:
@@ -2,27 +2,72 @@
 import torch
 import math
 import torch.nn as nn
+from torch.nn import functional as F
+
+class SwiGLUFeedForward(nn.Module):
+    def __init__(self, embed_size, hidden_size):
+        super(SwiGLUFeedForward, self).__init__()
+        # Gate and value projections share one matmul
+        self.w1 = nn.Linear(embed_size, 2 * hidden_size)
+        self.w2 = nn.Linear(hidden_size, embed_size)
+
+    def forward(self, x):
+        # Under the per-block compile() in train_model, Inductor fuses the split, SiLU and multiply
+        # into a single pointwise kernel between the two matmuls
+        gate, value = self.w1(x).chunk(2, dim=-1)
+        return self.w2(F.silu(gate) * value)
 
 class GPTTransformerBlock(nn.Module):
     def __init__(self, embed_size, heads, forward_expansion, dropout_rate):
         super(GPTTransformerBlock, self).__init__()
-        self.attention = nn.MultiheadAttention(embed_dim=embed_size, num_heads=heads)
+        assert embed_size % heads == 0, "embed_size must be divisible by heads"
+        self.heads = heads
+        self.head_dim = embed_size // heads
+        self.qkv_proj = nn.Linear(embed_size, 3 * embed_size)
+        self.out_proj = nn.Linear(embed_size, embed_size)
         self.dropout = nn.Dropout(dropout_rate)  # Dropout layer
         self.norm1 = nn.LayerNorm(embed_size)
         self.norm2 = nn.LayerNorm(embed_size)
-        self.feed_forward = nn.Sequential(
-            nn.Linear(embed_size, forward_expansion * embed_size),
-            nn.GELU(),
-            nn.Linear(forward_expansion * embed_size, embed_size)
-        )
-
-    def forward(self, x, attn_mask=None, key_padding_mask=None):
-        attention_output, _ = self.attention(
-            x, x, x,
-            attn_mask=attn_mask,
-            key_padding_mask=key_padding_mask
-        )
+        self.feed_forward = SwiGLUFeedForward(embed_size, forward_expansion * embed_size)
+
+    def attention(self, x, key_padding_mask=None, past_kv=None):
+        batch_size, seq_len, embed_size = x.shape
+        # [batch_size, seq_len, 3 * embed_size] -> 3 x [batch_size, heads, seq_len, head_dim]
+        qkv = self.qkv_proj(x).view(batch_size, seq_len, 3, self.heads, self.head_dim)
+        q, k, v = qkv.permute(2, 0, 3, 1, 4).unbind(0)
+
+        if past_kv is not None:
+            past_k, past_v = past_kv
+            k = torch.cat((past_k, k), dim=2)
+            v = torch.cat((past_v, v), dim=2)
+        present_kv = (k, v)
+        kv_len = k.size(2)
+
+        if key_padding_mask is None and kv_len == seq_len:
+            # Lets SDPA pick the fused FlashAttention / memory-efficient kernels
+            out = F.scaled_dot_product_attention(q, k, v, is_causal=True)
+        elif key_padding_mask is None and seq_len == 1:
+            # A single new query may attend to every cached position
+            out = F.scaled_dot_product_attention(q, k, v)
+        else:
+            # SDPA boolean masks mark the positions that may be attended to; queries sit at
+            # the end of the key sequence when a cache is in use
+            attn_mask = torch.ones(seq_len, kv_len, dtype=torch.bool, device=x.device).tril(diagonal=kv_len - seq_len)
+            if key_padding_mask is not None:
+                attn_mask = attn_mask & ~key_padding_mask[:, None, None, :]
+                # Always let a query see its own position so a padded query (e.g. left padding)
+                # does not end up with an all-masked row, which SDPA turns into NaNs
+                query_positions = torch.arange(kv_len - seq_len, kv_len, device=x.device)
+                attn_mask = attn_mask | (query_positions[:, None] == torch.arange(kv_len, device=x.device))
+            out = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask)
+
+        out = out.transpose(1, 2).reshape(batch_size, seq_len, embed_size)
+        return self.out_proj(out), present_kv
+
+    def forward(self, x, key_padding_mask=None, past_kv=None):
+        # x: [batch_size, seq_len, embed_size]; past_kv holds this block's cached keys/values
+        attention_output, present_kv = self.attention(x, key_padding_mask=key_padding_mask, past_kv=past_kv)
         x = self.norm1(self.dropout(attention_output) + x)
         forward_output = self.feed_forward(x)
         out = self.norm2(self.dropout(forward_output) + x)
-        return out
\ No newline at end of file
+        return out, present_kv
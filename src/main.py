@@ -124,6 +124,13 @@ def train_model(bucket_name, train_blob_name, val_blob_name):
         enable_progress_bar=True
     )
 
+    # Compile each transformer block in place so Inductor fuses the residual-add, LayerNorm,
+    # dropout and SwiGLU element-wise kernels. Lightning rejects a torch.compile'd LightningModule
+    # under DeepSpeed, but compiling submodules leaves the module and its state dict keys unchanged.
+    if torch.cuda.is_available():
+        for layer in model.layers:
+            layer.compile()
+
     # Train the model
     trainer.fit(model, datamodule=data_module)
     tb_logger.save()
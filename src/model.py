@@ -1,10 +1,12 @@
 # model.py
+import math
 import torch
 import lightning as L
 import torch.nn as nn
 
 from torch.nn import functional as F
 from layers import GPTTransformerBlock
+from dataset import Batch
 from util import sinusoidal_positional_encoding
 
 class GPTModel(L.LightningModule):
@@ -28,64 +30,64 @@ class GPTModel(L.LightningModule):
         self.example_input_array = torch.zeros((1, sequence_length), dtype=torch.long)
 
         self.embedding = nn.Embedding(self.vocab_size, self.embed_size)
-        self.pos_embbedings = nn.Parameter(sinusoidal_positional_encoding(embed_size, max_len=sequence_length))
+        # Fixed sinusoidal encoding: a buffer keeps it out of the optimizer state and backward pass
+        self.register_buffer('pos_embeddings', sinusoidal_positional_encoding(embed_size, max_len=sequence_length))
 
         self.layers = nn.ModuleList([
             GPTTransformerBlock(embed_size, heads, forward_expansion, dropout_rate)
             for _ in range(num_layers)
         ])
-        self.output_layer = nn.Linear(embed_size, vocab_size, bias=False)
-        self.output_layer.weight = self.embedding.weight
 
-    def forward(self, x, attention_mask=None):
+    def forward(self, x, key_padding_mask=None, past_kv=None, use_cache=False):
+        """
+        key_padding_mask is a bool [batch_size, kv_len] tensor, True at padded key positions
+        (including cached ones). Leave it as None for right-padded batches: causal attention
+        already keeps real tokens from attending to trailing padding, and no mask keeps SDPA on
+        its fused kernels.
+        """
         seq_len = x.size(1)
-        device = x.device
+        # With a KV cache, x only holds the new tokens, which start after the cached ones
+        past_len = past_kv[0][0].size(2) if past_kv is not None else 0
 
         x = self.embedding(x)
-        x = x + self.pos_embbedings[:, :seq_len, :]
-        x = x.transpose(0, 1)  # Shape: [seq_len, batch_size, embed_size]
+        x = x + self.pos_embeddings[:, past_len:past_len + seq_len, :]  # Shape: [batch_size, seq_len, embed_size]
 
-        # Create causal mask
-        causal_mask = torch.triu(torch.ones(seq_len, seq_len, device=device), diagonal=1).bool()
-        # Create key padding mask [batch_size, seq_len]
-        key_padding_mask = None
-        if attention_mask is not None:
-            key_padding_mask = attention_mask.squeeze(1).to(device) == 0  # Convert to boolean mask
+        present_kv = []
+        for i, layer in enumerate(self.layers):
+            x, layer_kv = layer(x, key_padding_mask=key_padding_mask, past_kv=past_kv[i] if past_kv is not None else None)
+            present_kv.append(layer_kv)
 
-        for layer in self.layers:
-            x = layer(x, attn_mask=causal_mask, key_padding_mask=key_padding_mask)
-
-        x = self.output_layer(x)
-        x = x.transpose(0, 1)  # Shape: [batch_size, seq_len, vocab_size]
+        # Output projection is tied to the embedding weights
+        x = F.linear(x, self.embedding.weight)  # Shape: [batch_size, seq_len, vocab_size]
+        if use_cache:
+            return x, present_kv
         return x
-    
-    def create_causal_mask(self, size):
-        mask = torch.triu(torch.ones(size, size), diagonal=1).bool()
-        return mask
-        
-    def masked_loss(self, outputs, targets, masks):
-        # Flatten outputs and targets
-        outputs_flat = outputs.reshape(-1, self.vocab_size)  # Use reshape instead of view
-        targets_flat = targets.reshape(-1)
 
-        # Use masks to filter out loss from padding tokens
-        mask = masks.view(-1) == 1  # Flatten and convert to boolean mask
-        outputs_masked = outputs_flat[mask]
-        targets_masked = targets_flat[mask]
+    def transfer_batch_to_device(self, batch, device, dataloader_idx):
+        # Pinned batches can be copied asynchronously with the host
+        if isinstance(batch, Batch):
+            return batch.to(device, non_blocking=True)
+        return super().transfer_batch_to_device(batch, device, dataloader_idx)
 
-        # Calculate cross-entropy loss only on non-padded tokens
-        return F.cross_entropy(outputs_masked, targets_masked)
+    def masked_loss(self, outputs, targets, masks):
+        # Mark padded positions as ignored so cross_entropy skips them without a boolean gather
+        targets = targets.masked_fill(masks == 0, -100)
+        return F.cross_entropy(outputs.reshape(-1, self.vocab_size), targets.reshape(-1), ignore_index=-100)
 
     def training_step(self, batch):
         inputs, targets, masks = batch
-        outputs = self(inputs, attention_mask=masks)
+        # Dataset padding is always trailing, so no key padding mask is needed; masks only
+        # drop padded positions from the loss
+        outputs = self(inputs)
         loss = self.masked_loss(outputs, targets, masks)
         self.log('train_loss', loss, on_step=True, on_epoch=True, prog_bar=True, logger=True)
         return loss
 
     def validation_step(self, batch):
         inputs, targets, masks = batch
-        outputs = self(inputs, attention_mask=masks)
+        # Dataset padding is always trailing, so no key padding mask is needed; masks only
+        # drop padded positions from the loss
+        outputs = self(inputs)
         loss = self.masked_loss(outputs, targets, masks)
         self.log('val_loss', loss, on_epoch=True, prog_bar=True, logger=True)
         return loss
@@ -122,11 +124,6 @@ class WarmupCosineLR(torch.optim.lr_scheduler._LRScheduler):
             lr_scale = self.last_epoch / self.warmup_steps
         else:
             progress = (self.last_epoch - self.warmup_steps) / (self.total_steps - self.warmup_steps)
-            lr_scale = 0.5 * (1.0 + torch.cos(torch.tensor(progress, device=self._get_device())))
+            lr_scale = 0.5 * (1.0 + math.cos(math.pi * progress))
 
         return [base_lr * lr_scale + self.min_lr for base_lr in self.base_lrs]
-
-    def _get_device(self):
-        return self.optimizer.param_groups[0]['params'][0].device
-
-
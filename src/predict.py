@@ -82,18 +82,18 @@ def load_model(bucket_name, experiments_folder, model_version=None):
 
 def top_p_filtering(logits, top_p=0.9, filter_value=-float('Inf')):
     """ Filter a distribution of logits using nucleus (top-p) sampling """
-    sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+    sorted_logits, sorted_indices = torch.sort(logits, descending=True, dim=-1)
     cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
 
     # Remove tokens with cumulative probability above the threshold (nucleus)
     sorted_indices_to_remove = cumulative_probs > top_p
     # Shift the indices to the right to keep the first token above the threshold
     sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
-    sorted_indices_to_remove[..., 0] = 0
+    sorted_indices_to_remove[..., 0] = False
 
-    indices_to_remove = sorted_indices[sorted_indices_to_remove]
-    logits[indices_to_remove] = filter_value
-    return logits
+    # Mask in sorted order, then scatter back to vocabulary order in one pass
+    sorted_logits.masked_fill_(sorted_indices_to_remove, filter_value)
+    return logits.scatter_(-1, sorted_indices, sorted_logits)
 
 def generate_text(input_text, tokenizer, model, sequence_length=128, temperature=1.0, top_p=0.9):
     if not input_text.strip():
@@ -106,15 +106,21 @@ def generate_text(input_text, tokenizer, model, sequence_length=128, temperature
         raise ValueError("Input text could not be tokenized")
 
     # Convert to tensor and add batch dimension
-    input_ids = torch.tensor([input_ids], dtype=torch.long)
+    device = next(model.parameters()).device
+    input_ids = torch.tensor([input_ids], dtype=torch.long, device=device)
 
     print(f"Encoded input ids: {input_ids}")  # Debug print
 
-    # Generate text
-    with torch.no_grad():
+    # Generate text, feeding only the newest token once the prompt is in the KV cache
+    past_kv = None
+    next_input_ids = input_ids
+    with torch.inference_mode(), torch.autocast(device.type, dtype=torch.bfloat16, enabled=device.type == 'cuda'):
         for _ in range(sequence_length):
-            outputs = model(input_ids)
-            logits = outputs[0, -1, :] / temperature  # Select the logits for the last word in the sequence
+            # Positional encodings only cover the model's training sequence length
+            if input_ids.size(1) > model.sequence_length:
+                break
+            outputs, past_kv = model(next_input_ids, past_kv=past_kv, use_cache=True)
+            logits = outputs[0, -1, :].float() / temperature  # Select the logits for the last word in the sequence
             filtered_logits = top_p_filtering(logits, top_p=top_p)
 
             # Sample from the filtered distribution
@@ -129,6 +135,7 @@ def generate_text(input_text, tokenizer, model, sequence_length=128, temperature
             # Add batch dimension to make it a 2D tensor
             next_token_id = next_token_id.unsqueeze(0).unsqueeze(0)  # Add two dimensions to make it a 2D tensor
             input_ids = torch.cat((input_ids, next_token_id), dim=-1)
+            next_input_ids = next_token_id
 
     generated_text = tokenizer.decode(input_ids[0].tolist())
     print(f"Generated text: {generated_text}")  # Debug print
@@ -141,6 +148,10 @@ def predict_model(input_text, bucket_name, experiments_folder, model_version=Non
     model, hparams = load_model(bucket_name, experiments_folder, model_version)
     sequence_length = hparams.get('sequence_length', 128)
 
+    # Run inference in bfloat16 on the GPU when one is available
+    if torch.cuda.is_available():
+        model = model.to(device='cuda', dtype=torch.bfloat16).eval()
+
     # Generate text using the trained model
     generated_text = generate_text(input_text, tokenizer, model, sequence_length=sequence_length)
     
@@ -4,7 +4,7 @@ import math
 import torch
 from dataset import TokenizedTextDataset  
 
-# Initalize with sinusoidal positional encoding but still learnable 
+# Fixed sinusoidal positional encoding, shape [1, max_len, embed_size]
 def sinusoidal_positional_encoding(embed_size, max_len):
     pe = torch.zeros(max_len, embed_size)
     position = torch.arange(0, max_len, dtype=torch.float).unsqueeze(1)
@@ -8,9 +8,9 @@ def test_masks():
     #model = GPTModel(...)  # Initialize with appropriate parameters
     model = None #GPTModel
     x = torch.randint(0, 50233, (batch_size, seq_len))
-    attention_mask = torch.ones(batch_size, 1, seq_len)
+    key_padding_mask = torch.zeros(batch_size, seq_len, dtype=torch.bool)
 
-    output = model(x, attention_mask=attention_mask)
+    output = model(x, key_padding_mask=key_padding_mask)
     assert output.shape == (batch_size, seq_len, 50233), "Output shape mismatch"
 
 test_masks()
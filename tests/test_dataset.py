@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+import torch
+from torch.utils.data import RandomSampler, SequentialSampler
+from dataset import BucketBatchSampler, GPTDataModule, TokenizedTextDataset, collate_fn
+
+SEQUENCE_LENGTH = 6
+LINES = ["1 2 3", "4 5 6 7 8 9 10 11", "", "11", "3 0 4", "7 7 7 7 7", "12 13"]
+
+# Fixture for a tokenized text file with blank, long and zero-token lines
+@pytest.fixture
+def token_file(tmp_path):
+    path = tmp_path / "tokens.txt"
+    path.write_text("\n".join(LINES) + "\n", encoding="utf-8")
+    return str(path)
+
+def fixed_length_sample(line, sequence_length, padding_token=0):
+    """ The original pad-to-sequence_length sample, kept as a reference """
+    sequence = list(map(int, line.split()))
+    if len(sequence) < sequence_length:
+        sequence += [padding_token] * (sequence_length - len(sequence))
+    else:
+        sequence = sequence[:sequence_length]
+    attention_mask = [1 if token != padding_token else 0 for token in sequence]
+    return sequence[:-1], sequence[1:], attention_mask[:-1]
+
+def kept_pairs(inputs, targets, masks):
+    """ (input, target) pairs at the positions the loss keeps """
+    return [(int(i), int(t)) for i, t, m in zip(inputs, targets, masks) if m]
+
+def test_in_memory_and_lazy_samples_match(token_file):
+    in_memory = TokenizedTextDataset(token_file, SEQUENCE_LENGTH, in_memory=True)
+    lazy = TokenizedTextDataset(token_file, SEQUENCE_LENGTH, in_memory=False)
+    assert len(in_memory) == len(lazy) == len(LINES)
+    assert in_memory.lengths.tolist() == lazy.lengths.tolist()
+    for idx in range(len(LINES)):
+        for a, b in zip(in_memory[idx], lazy[idx]):
+            assert a.dtype == b.dtype and torch.equal(a, b), f"Sample {idx} differs between paths"
+
+@pytest.mark.parametrize("in_memory", [True, False])
+def test_loss_positions_match_fixed_length_samples(token_file, in_memory):
+    dataset = TokenizedTextDataset(token_file, SEQUENCE_LENGTH, in_memory=in_memory)
+    for idx, line in enumerate(LINES):
+        expected = kept_pairs(*fixed_length_sample(line, SEQUENCE_LENGTH))
+        assert kept_pairs(*dataset[idx]) == expected, f"Loss positions differ for line {line!r}"
+
+def test_collate_pads_to_batch_max(token_file):
+    dataset = TokenizedTextDataset(token_file, SEQUENCE_LENGTH)
+    samples = [dataset[0], dataset[2], dataset[3]]  # lengths 3, 1 and 1
+    inputs, targets, masks = collate_fn(samples)
+    assert inputs.shape == targets.shape == masks.shape == (3, 3), "Batch should pad to its longest sample"
+    assert torch.equal(inputs[0], samples[0][0])
+    assert torch.equal(inputs[2], torch.tensor([11, 0, 0]))
+    assert masks.tolist() == [[True, True, True], [False, False, False], [True, False, False]]
+    for i, sample in enumerate(samples):
+        assert kept_pairs(inputs[i], targets[i], masks[i]) == kept_pairs(*sample)
+
+@pytest.mark.parametrize("num_samples,batch_size,bucket_factor", [(7, 2, 1), (7, 3, 2), (100, 8, 3), (5, 8, 50), (64, 8, 2)])
+def test_sampler_length_matches_batches(num_samples, batch_size, bucket_factor):
+    lengths = torch.randint(0, 20, (num_samples,)).numpy()
+    sampler = BucketBatchSampler(RandomSampler(range(num_samples)), lengths, batch_size, bucket_factor=bucket_factor)
+    batches = list(sampler)
+    assert len(sampler) == len(batches)
+    assert sorted(i for batch in batches for i in batch) == list(range(num_samples)), "Every index once"
+    assert all(len(batch) <= batch_size for batch in batches)
+
+def test_sampler_groups_similar_lengths():
+    lengths = torch.randperm(40).numpy()  # Distinct lengths in shuffled order
+    sampler = BucketBatchSampler(SequentialSampler(range(40)), lengths, batch_size=4, bucket_factor=10)
+    for batch in sampler:
+        assert max(lengths[batch]) - min(lengths[batch]) == 3, "Batches should be cut from the sorted pool"
+
+def test_sampler_reproducible_and_reshuffles_each_epoch():
+    lengths = torch.randperm(64).numpy()
+    first = BucketBatchSampler(SequentialSampler(range(64)), lengths, batch_size=4, bucket_factor=2, seed=3)
+    second = BucketBatchSampler(SequentialSampler(range(64)), lengths, batch_size=4, bucket_factor=2, seed=3)
+    epochs = [list(first) for _ in range(2)]
+    assert epochs == [list(second) for _ in range(2)], "Same seed should give the same batch order"
+    assert epochs[0] != epochs[1], "Batch order should change between epochs"
+
+def test_binary_cache_written_atomically(token_file, tmp_path):
+    tokens_path, offsets_path = TokenizedTextDataset.preprocess_to_binary(token_file)
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted(["tokens.txt", "tokens.txt.tokens.i32", "tokens.txt.offsets.npy"]), "No temp files should be left behind"
+    lengths = [len(line.split()) for line in LINES]
+    assert torch.from_numpy(np.load(offsets_path)).diff().tolist() == lengths
+    assert np.fromfile(tokens_path, dtype=np.int32).tolist() == [int(t) for line in LINES for t in line.split()]
+
+@pytest.mark.parametrize("in_memory", [True, False])
+def test_train_loader_skips_blank_lines(tmp_path, in_memory):
+    path = tmp_path / "tokens.txt"
+    path.write_text("\n".join(["1 2 3 4"] * 200 + [""] * 40) + "\n", encoding="utf-8")
+    data_module = GPTDataModule("train", "val", "bucket", batch_size=32, sequence_length=SEQUENCE_LENGTH)
+    data_module.train_dataset = TokenizedTextDataset(str(path), SEQUENCE_LENGTH, in_memory=in_memory)
+    batches = list(data_module.train_dataloader())
+    assert all(batch.masks.any(dim=1).all() for batch in batches), "No sample should be fully masked"
+    assert sum(batch.inputs.size(0) for batch in batches) == 200
@@ -0,0 +1,40 @@
+import pytest
+import torch
+from model import GPTModel
+
+# Fixture for a small model in eval mode (no dropout) with fixed weights
+@pytest.fixture
+def model():
+    torch.manual_seed(0)
+    model = GPTModel(embed_size=32, num_layers=2, heads=4, forward_expansion=4, dropout_rate=0.0,
+                     vocab_size=100, batch_size=2, sequence_length=16, max_epochs=1, dataset_length=10)
+    return model.eval()
+
+@pytest.fixture
+def input_ids():
+    torch.manual_seed(1)
+    return torch.randint(0, 100, (2, 12))
+
+# Prefill part of the sequence, then decode the rest one token at a time
+def test_kv_cache_single_token_steps(model, input_ids):
+    with torch.no_grad():
+        full_logits = model(input_ids)
+        logits, past_kv = model(input_ids[:, :5], use_cache=True)
+        assert torch.allclose(logits, full_logits[:, :5], atol=1e-5), "Prefill logits mismatch"
+
+        for i in range(5, input_ids.size(1)):
+            logits, past_kv = model(input_ids[:, i:i+1], past_kv=past_kv, use_cache=True)
+            assert torch.allclose(logits[:, 0], full_logits[:, i], atol=1e-5), f"Cached step {i} mismatch"
+
+    assert past_kv[0][0].shape == (2, 4, input_ids.size(1), 8), "Cache should hold every position"
+
+# Feed several new tokens on top of a cache, which uses the offset causal mask
+def test_kv_cache_multi_token_chunk(model, input_ids):
+    with torch.no_grad():
+        full_logits = model(input_ids)
+        _, past_kv = model(input_ids[:, :4], use_cache=True)
+        logits, past_kv = model(input_ids[:, 4:9], past_kv=past_kv, use_cache=True)
+        assert torch.allclose(logits, full_logits[:, 4:9], atol=1e-5), "Chunk on top of cache mismatch"
+
+        logits, _ = model(input_ids[:, 9:], past_kv=past_kv, use_cache=True)
+        assert torch.allclose(logits, full_logits[:, 9:], atol=1e-5), "Second chunk mismatch"